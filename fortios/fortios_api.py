@@ -47,6 +47,10 @@ options:
             permanent_objects:
                 required: false
                 description: A list of identifiers for objects at the endpoint that cannot be deleted.
+            ordered_list_params:
+                required: false
+                description: Keys of lists whose element order is significant. Other lists are
+                             compared regardless of the order of their elements.
 
 '''
 EXAMPLES = '''
@@ -148,6 +148,8 @@ changed:
     type: boolean
 '''
 
+import json
+
 from ansible.module_utils.fortios_api import API
 
 
@@ -166,6 +168,7 @@ class FirewallAPI(API):
         super(FirewallAPI, self).__init__(module)
         self._validate_policies()
         self._object_map = []
+        self._fingerprint_indexes = {}
 
     def _validate_policies(self):
         policy_specification = self._get_argument_spec()
@@ -224,20 +227,67 @@ class FirewallAPI(API):
 
     def apply_configuration_to_endpoint(self):
         self._execute_config_changes()
+        planned_moves = []
         if self._full_config:
             self._build_object_map()
-            self._move_existing_policies()
+            planned_moves = self._plan_policy_moves()
+            self._change_plan.moves = planned_moves
+            self._move_existing_policies(planned_moves)
+            if planned_moves:
+                self._touched_object_ids = None  # order has to be read back from the whole table
         if not self._check_mode:
             message, changed, failed = self._process_response()
             changed = changed or self._order_changed()
         else:
             message = "Check Mode"
-            original_match, update_match = self._original_or_update_match_current_configuration()
-            changed = not update_match or self._order_changed()
+            changed = bool(self._change_plan)
             failed = False
 
-        self._module.exit_json(msg=message, changed=changed, failed=failed,
-                               existing=self._fortigate_current_config, proposed=self._update_config, new=self._diff_configs())
+        self._module.exit_json(msg=message, changed=changed, failed=failed, planned_moves=len(planned_moves),
+                               plan=self._change_plan.to_dict(), existing=self._fortigate_current_config,
+                               proposed=self._update_config, new=self._change_plan.diff())
+
+    def _create_new_objects(self):
+        if not self._update_config or not self._full_config:
+            return super(FirewallAPI, self)._create_new_objects()
+
+        failures = {}
+        if not self._check_mode:
+            policy_runs = self._group_new_policies_by_anchor()
+            for policy_run, responses in zip(policy_runs, self._run_concurrently(self._create_policy_run, policy_runs)):
+                self._collect_failures(policy_run[1], responses, failures)
+        self._check_create_failures(failures)
+
+    def _group_new_policies_by_anchor(self):
+        # consecutive new policies in the desired order form a run that is
+        # created right after the existing policy preceding it (or before the
+        # one following it), so new policies need no move afterwards
+        new_policy_ids = set(o[self._object_identifier] for o in self._get_new_objects())
+        policy_runs = []
+        policy_run = None
+        previous_id = None
+        for forti_object in self._update_config:
+            policy_id = forti_object[self._object_identifier]
+            if policy_id in new_policy_ids:
+                if policy_run is None:
+                    policy_run = (("after", previous_id) if previous_id is not None else None, [])
+                    policy_runs.append(policy_run)
+                policy_run[1].append(forti_object)
+            elif policy_id in self._current_config_index:
+                if policy_run is not None and policy_run[0] is None:
+                    policy_runs[-1] = (("before", policy_id), policy_run[1])
+                policy_run = None
+                previous_id = policy_id
+        return policy_runs
+
+    def _create_policy_run(self, policy_run):
+        anchor, policies = policy_run
+        responses = []
+        for forti_object in policies:
+            params = {anchor[0]: str(anchor[1])} if anchor else None
+            responses.append(self._create(self._endpoint, params=params, data=forti_object))
+            anchor = ("after", forti_object[self._object_identifier])
+        return responses
 
     def _order_changed(self):
         try:
@@ -246,77 +296,97 @@ class FirewallAPI(API):
         except IndexError:
             return True
 
-    def _identify_highest_distance_move(self):
-        index = None
-        highest = 0
-        for i, policy_info in enumerate(self._object_map):
-            if policy_info:
-                move_distance = policy_info[2]
-                if move_distance > highest:
-                    index = i
-                    highest = move_distance
-        return index
-
-    def _get_policy_index_from_object_map(self, target_policy_id):
-        index = None
-        for i, policy_info in enumerate(self._object_map):
-            policy_id = policy_info[1]
-            if policy_id == target_policy_id:
-                index = i
-                break
-        return index
-
-    def _move_existing_policies(self):
-        mpol_target_index = self._identify_highest_distance_move()
-        while mpol_target_index is not None:
-            self._move_policy(mpol_target_index)
-            mpol_target_index = self._identify_highest_distance_move()
-
-    def _move_policy(self, mpol_target_index):
-        # move policy is the one going to its final position
-        mpol_info = self._object_map[mpol_target_index]
-        mpol_cur_index = mpol_info[0]
-        mpol_id = mpol_info[1]
-
-        target_index_id = self._fortigate_current_config[
-            mpol_target_index]['policyid']
-
-        if mpol_target_index > mpol_cur_index:
-            self._fortigate_current_config.insert(
-                mpol_target_index + 1, self._fortigate_current_config[mpol_cur_index])
-            del self._fortigate_current_config[mpol_cur_index]
-            if not self._check_mode:
-                self._edit('/'.join([self._endpoint, str(mpol_id)]),
-                           params={"action": "move", "after": str(target_index_id), "vdom": self._vdom})
-        else:
-            self._fortigate_current_config.insert(
-                mpol_target_index, self._fortigate_current_config[mpol_cur_index])
-            del self._fortigate_current_config[mpol_cur_index + 1]
-            if not self._check_mode:
-                self._edit('/'.join([self._endpoint, str(mpol_id)]),
-                           params={"action": "move", "before": str(target_index_id), "vdom": self._vdom})
+    def _plan_policy_moves(self):
+        # policies on the longest increasing subsequence of current positions
+        # (taken in desired order) are already in the right relative order and
+        # stay where they are; every other policy is moved once, anchored to
+        # its neighbour in the desired order
+        matched = [policy_info for policy_info in self._object_map if policy_info]
+        keep = self._longest_increasing_subsequence([policy_info[0] for policy_info in matched])
+        if not keep:
+            return []
+
+        moves = []
+        first_kept = min(keep)
+        for i in range(first_kept - 1, -1, -1):
+            moves.append((matched[i][1], "before", matched[i + 1][1]))
+        for i in range(first_kept + 1, len(matched)):
+            if i not in keep:
+                moves.append((matched[i][1], "after", matched[i - 1][1]))
+        return moves
+
+    def _longest_increasing_subsequence(self, sequence):
+        # patience sorting, returns the positions in sequence that form the
+        # subsequence
+        tails = []
+        tail_positions = []
+        predecessors = [None] * len(sequence)
+        for i, value in enumerate(sequence):
+            low, high = 0, len(tails)
+            while low < high:
+                middle = (low + high) // 2
+                if tails[middle] < value:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low > 0:
+                predecessors[i] = tail_positions[low - 1]
+            if low == len(tails):
+                tails.append(value)
+                tail_positions.append(i)
+            else:
+                tails[low] = value
+                tail_positions[low] = i
+
+        positions = set()
+        position = tail_positions[-1] if tail_positions else None
+        while position is not None:
+            positions.add(position)
+            position = predecessors[position]
+        return positions
+
+    def _move_existing_policies(self, moves):
+        for mpol_id, direction, target_id in moves:
+            self._move_policy(mpol_id, direction, target_id)
+
+    def _move_policy(self, mpol_id, direction, target_id):
+        # move policy is the one going to its final position. The move is
+        # applied to the local copy of the policy table instead of fetching
+        # the table again, _process_response reads the final order back once.
+        mpol = self._fortigate_current_config.pop(self._find_policy_index_in_current_config_by_id(mpol_id))
+        target_index = self._find_policy_index_in_current_config_by_id(target_id)
+        if direction == "after":
+            target_index += 1
+        self._fortigate_current_config.insert(target_index, mpol)
 
-        self._build_object_map()
+        if not self._check_mode:
+            self._edit('/'.join([self._endpoint, str(mpol_id)]),
+                       params={"action": "move", direction: str(target_id), "vdom": self._vdom})
 
     def _find_policy_index_in_current_config_by_id(self, policy_id):
         for i, p in enumerate(self._fortigate_current_config):
-            if p['policyid'] == policy_id:
+            if p[self._object_identifier] == policy_id:
                 return i
         return False
 
     def _get_index_of_matching_object(self, forti_object):
-        found = False
-        existing_index = 0
-        existing_object_count = len(self._fortigate_current_config)
-
-        while not found and existing_index < existing_object_count:
-            if not self._diff_unknown(self._fortigate_current_config[existing_index], forti_object):
-                return existing_index
-            existing_index = existing_index + 1
-        return None
+        # current policies are fingerprinted once per distinct policy shape,
+        # so each lookup is a dictionary access instead of a scan with diffs
+        shape = self._object_shape(forti_object)
+        shape_key = json.dumps(shape, sort_keys=True)
+        fingerprint_index = self._fingerprint_indexes.get(shape_key)
+        if fingerprint_index is None:
+            fingerprint_index = {}
+            for existing_index, existing_object in enumerate(self._fortigate_current_config):
+                fingerprint = self._fingerprint(self._expand_defaults(existing_object), shape)
+                if fingerprint not in fingerprint_index:
+                    fingerprint_index[fingerprint] = existing_index
+            self._fingerprint_indexes[shape_key] = fingerprint_index
+        return fingerprint_index.get(self._fingerprint(forti_object, shape))
 
     def _build_object_map(self):
         self._get_current_configuration()
+        self._fingerprint_indexes = {}
         if not self._update_config:
             self._object_map = [None] * len(self._fortigate_current_config)
         else:
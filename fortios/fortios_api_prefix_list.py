@@ -113,6 +113,7 @@ prefix_list_api_args = {
     'list_identifier': 'prefixes',
     'object_identifier': 'name',
     'default_ignore_params': [],
+    'ordered_list_params': ['rule'],
 }
 
 
@@ -115,6 +115,7 @@ prefix_list_api_args = {
     'list_identifier': 'route-map',
     'object_identifier': 'name',
     'default_ignore_params': [],
+    'ordered_list_params': ['rule'],
 }
 
 
@@ -29,9 +29,13 @@
 #
 import os
 import time
+import fcntl
+import threading
 import traceback
 import json
+from collections import Counter, OrderedDict
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 from ansible.module_utils.basic import AnsibleModule, _load_params
 from ansible.module_utils._text import to_native
@@ -47,11 +51,21 @@ except ImportError:
 try:
     import requests
     from requests import ConnectionError
+    from requests.adapters import HTTPAdapter
 
     HAS_REQUESTS = True
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    # use_float was added to ijson.parse in 3.1
+    HAS_IJSON = tuple(int(v) for v in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (ImportError, AttributeError, ValueError):
+    HAS_IJSON = False
+
 fortios_argument_spec = dict(
     file_mode=dict(type='bool', default=False),
     config_file=dict(type='path'),
@@ -213,9 +227,12 @@ fortios_api_argument_spec = dict(
     conn_params=dict(
         params=dict(
             fortigate_ip=dict(required=True),
-            fortigate_username=dict(type='str', required=True),
-            fortigate_password=dict(type='str', required=True, no_log=True),
+            fortigate_username=dict(type='str'),
+            fortigate_password=dict(type='str', no_log=True),
+            api_key=dict(type='str', no_log=True),
             port=dict(type='int'),
+            pool_size=dict(type='int', default=10),
+            session_cache=dict(type='path'),
             disable_warnings=dict(type='bool', default=False),
             ssh_keyfile=dict(type='path'),
             verify=dict(type='bool', default=True),
@@ -227,10 +244,25 @@ fortios_api_argument_spec = dict(
     default_ignore_params=dict(type='list'),
     endpoint_information=dict(type='dict'),
     delete_objects=dict(type='list',default=[]),
-    full_config=dict(type='bool',default=True)
+    full_config=dict(type='bool',default=True),
+    max_concurrency=dict(type='int', default=1),
+    fetch_managed_fields_only=dict(type='bool', default=False),
+    page_size=dict(type='int'),
+    stream_results=dict(type='bool', default=False),
+    exclude_default_values=dict(type='bool', default=False),
+    targeted_verification=dict(type='bool', default=False)
 )
 
 
+# compare and diff functions compiled from the arg spec of an endpoint, shared
+# by every API instance of the process working on that endpoint
+_compiled_comparators = {}
+
+# stands for an attribute missing from a projected object, unlike None it
+# never compares equal to an attribute that is present
+_MISSING = {'__missing__': True}
+
+
 def connection_handler(func):
     def func_wrapper(*args, **kwargs):
         api = args[0]
@@ -272,8 +304,58 @@ def return_handler(func):
     return return_wrapper
 
 
+class ChangePlan(object):
+    # what a run changes on an endpoint, worked out once from the current and
+    # the desired configuration. Every phase and the final report read it
+    # instead of comparing the configurations again.
+
+    def __init__(self, object_identifier=None):
+        self.object_identifier = object_identifier
+        self.cleared = False
+        self.deletes = []
+        # identifier -> (payload sent to the device, attributes that differ)
+        self.updates = OrderedDict()
+        # identifier -> default object sent to the device
+        self.resets = OrderedDict()
+        self.creates = []
+        # (identifier, "before" or "after", identifier of the anchor)
+        self.moves = []
+
+    def __bool__(self):
+        return bool(self.cleared or self.deletes or self.updates or self.resets or self.creates or self.moves)
+
+    __nonzero__ = __bool__
+
+    def update_deltas(self):
+        deltas = []
+        for object_identifier, (payload, delta) in self.updates.items():
+            delta = self._prune(delta)
+            if self.object_identifier:
+                delta[self.object_identifier] = object_identifier
+            deltas.append(delta)
+        return deltas
+
+    def _prune(self, delta):
+        # _diff_objects leaves None for attributes that turned out to match,
+        # such as a member list that only changed order
+        if isinstance(delta, dict):
+            return dict((k, self._prune(v)) for k, v in delta.items() if v is not None)
+        return delta
+
+    def diff(self):
+        # attributes changed on existing objects, followed by new objects
+        return self.update_deltas() + self.creates or None
+
+    def to_dict(self):
+        return dict(delete_all=self.cleared, delete=list(self.deletes), update=self.update_deltas(),
+                    reset=list(self.resets), create=[o[self.object_identifier] for o in self.creates],
+                    move=[list(move) for move in self.moves])
+
+
 class API(object):
 
+    _fail_lock = threading.Lock()
+
     def __init__(self, api_info):
 
         if not HAS_REQUESTS:
@@ -284,18 +366,24 @@ class API(object):
         self._fortigate_current_config = None
 
         self._params = _load_params()
-        self._vdom = self._params.get('vdom', "root")
+        self._max_concurrency = int(self._params.get('max_concurrency') or 1)
+        self._filter_batch_size = 50
 
         self._arg_spec_filename = "FortiosAPIArgSpecs.json"
 
         self._api_info = api_info
         if api_info.get('from_configs') is True:
             self._api_info = self._params['endpoint_information']
+        # a vdom in api_info lets several instances of one process work on
+        # different vdoms
+        self._vdom = self._api_info.get('vdom', self._params.get('vdom', "root"))
 
         self._match_ignore_params = self._api_info.get(
             'match_ignore_params', [])
         if self._match_ignore_params:
             self._match_ignore_params.append('name')
+        # lists are compared as multisets unless their key is listed here
+        self._ordered_list_params = set(self._api_info.get('ordered_list_params', []))
 
         if isinstance(self._api_info["endpoint"], list):
             self._endpoint = '/'.join(self._api_info["endpoint"])
@@ -309,22 +397,21 @@ class API(object):
         self.proxies = self._params['conn_params'].get('proxies')
 
         self._ip = self._build_target_ip()
-        response = self._login()
-        self.cookies = response.cookies
-        self.header = self._set_csrf_header()
-
-        if not response.cookies:
-            self.fail(
-                "Authentication failed. Authentication attempts likely blocked temporarily.")
-        if "just_logged_in" in response.cookies:
-            self.fail(
-                "Authentication with FortiOS device failed. Check your username/password.")
+        self._session = self._build_session()
+        self._api_key = self._params['conn_params'].get('api_key')
+        self._session_cache_file = self._params['conn_params'].get('session_cache')
+        self._authenticate()
 
         self._minimum_object_params = self._params.get('default_object', [])
+        # objects fetched with exclude_default_values also lack the
+        # default_ignore_params attributes, so they are expanded from the
+        # default object as the device reports it
+        self._device_default_object = self._get_device_default_object()
         self._default_object_configuration = self._get_default_object()
         self._object_identifier = self._api_info.get('object_identifier')
         self._permanent_object_ids = self._get_permanent_object_identifiers()
-        self._ignore_object_ids = self._get_ignore_object_identifiers()
+        self._permanent_object_id_set = set(self._permanent_object_ids)
+        self._ignore_object_ids = set(self._get_ignore_object_identifiers())
 
         self.http_status_codes = {
             200: "Request Successful.",
@@ -341,21 +428,31 @@ class API(object):
         }
 
         self._object_map = []
-        self._used_object_ids = []
-        self._existing_object_ids = []
-        self._object_ids_to_update = []
-        self._permanent_object_ids_to_reset = []
+        self._current_config_index = OrderedDict()
+        self._response_cache = {}
+        self._touched_object_ids = OrderedDict()
+        self._used_object_ids = set()
+        self._change_plan = ChangePlan()
 
         self._list_identifier = self._api_info['list_identifier']
         self._argument_spec = {self._list_identifier: dict(
             type='list', options=self._get_argument_spec())}
         self._argument_spec.update(fortios_api_argument_spec)
+        self._match_object, self._diff_object = self._get_comparators(
+            self._argument_spec[self._list_identifier]['options'])
 
         self._module = AnsibleModule(self._argument_spec, supports_check_mode=True)
         self._update_config = self._module.params.get(self._list_identifier) or []
         self._print_current_config = self._module.params.get('print_current_config')
         self._full_config = self._module.params.get('full_config')
         self._delete_objects = self._module.params.get('delete_objects')
+        self._fetch_managed_fields_only = self._module.params.get('fetch_managed_fields_only')
+        self._page_size = self._module.params.get('page_size')
+        self._stream_results = self._module.params.get('stream_results')
+        self._exclude_default_values = self._module.params.get('exclude_default_values')
+        self._targeted_verification = self._module.params.get('targeted_verification')
+        if self._stream_results and not HAS_IJSON:
+            self.fail('Could not import the python library ijson (3.1 or newer) required by stream_results.')
         self._check_mode = self._module.check_mode or self._print_current_config
 
     def apply_configuration_to_endpoint(self):
@@ -364,105 +461,422 @@ class API(object):
             message, changed, failed = self._process_response()
         else:
             message = "Check Mode"
-            changed = not self._configurations_match(
-                self._fortigate_original_config, self._update_config)
+            changed = bool(self._change_plan)
             failed = False
 
-        self._module.exit_json(msg=message, changed=changed, failed=failed,
+        self._module.exit_json(msg=message, changed=changed, failed=failed, plan=self._change_plan.to_dict(),
                                existing=self._fortigate_original_config, proposed=self._update_config, end_state=self._fortigate_current_config)
 
     def _execute_config_changes(self):
+        self._touched_object_ids = OrderedDict()
         self._get_current_configuration()
         if isinstance(self._fortigate_current_config, list):
+            cleared = self._clear_endpoint()
+            self._plan_changes()
+            self._change_plan.cleared = cleared
             self._delete_unused_objects()
             self._update_objects()
             self._create_new_objects()
         else:
+            self._select_single_object_update()
+            self._plan_changes()
             self._update_single_object_endpoint()
 
+    def _plan_changes(self):
+        self._change_plan = self._build_change_plan()
+        self._mark_touched(self._change_plan.updates)
+        self._mark_touched(self._change_plan.resets)
+        self._mark_touched(o[self._object_identifier] for o in self._change_plan.creates)
+
+    def _build_change_plan(self):
+        plan = ChangePlan(self._object_identifier)
+        if not isinstance(self._fortigate_current_config, list):
+            if self._single_object_update_needed():
+                plan.updates[None] = (self._update_config, self._get_update_delta(
+                    self._expand_defaults(self._fortigate_current_config), self._update_config, self._update_config))
+            return plan
+
+        def by_identifier(forti_object):
+            return forti_object[self._object_identifier]
+
+        # the fetch path holds the whole table, so both sides are sorted in
+        # memory here; _diff_streams itself only needs sorted iterables
+        managed_object_ids = set()
+        new_object_ids = set()
+        for operation, current_object, forti_object in self._diff_streams(
+                sorted(self._current_config_index.values(), key=by_identifier),
+                sorted(self._update_config, key=by_identifier)):
+            if operation == 'create':
+                object_identifier = forti_object[self._object_identifier]
+                if object_identifier not in self._current_config_index and \
+                        object_identifier not in self._permanent_object_id_set:
+                    new_object_ids.add(object_identifier)
+            elif operation != 'delete':
+                managed_object_ids.add(forti_object[self._object_identifier])
+            # update objects are compared with _objects_match, the predicate
+            # verification uses, so nothing it would flag is left out
+            if operation == 'update':
+                payload = self._build_update_payload(forti_object)
+                plan.updates[forti_object[self._object_identifier]] = (
+                    payload, self._get_update_delta(current_object, forti_object, payload))
+
+        plan.deletes = self._get_unused_object_ids()
+        # new objects are created in the order of the update config
+        plan.creates = [o for o in self._update_config if o[self._object_identifier] in new_object_ids]
+        for object_identifier in self._get_permanent_object_ids_to_reset(managed_object_ids):
+            plan.resets[object_identifier] = self._build_reset_object(object_identifier)
+        return plan
+
+    def _get_update_delta(self, current_object, forti_object, payload):
+        # empty desired values make _diff_objects report nothing, the
+        # attributes sent are the delta then
+        delta = self._diff_objects(current_object, forti_object)
+        if delta:
+            return delta
+        return dict((k, v) for k, v in payload.items() if k != self._object_identifier)
+
+    def _get_permanent_object_ids_to_reset(self, managed_object_ids):
+        # permanent objects that are not in the update config are reset to
+        # the defaults, unless they are already there
+        if self._update_config:
+            object_ids = [obj_id for obj_id in self._permanent_object_ids if obj_id not in managed_object_ids]
+        else:
+            delete_objects = set(self._delete_objects or [])
+            object_ids = [obj_id for obj_id in self._permanent_object_ids if obj_id in delete_objects and
+                          obj_id not in managed_object_ids]
+        return [obj_id for obj_id in object_ids if self._permanent_object_drifted(obj_id)]
+
     def _get_current_configuration(self):
+        fetch_params = self._build_fetch_params()
+        self._set_current_configuration(self._merge_fetch_responses(self._run_concurrently(
+            self._show_endpoint, fetch_params)))
+
+    def _show_endpoint(self, params):
+        cached_response = self._get_cached_response(self._endpoint, params)
+        if cached_response is not None:
+            return cached_response
+        return self._cache_response(self._endpoint, params, self._fetch_endpoint(params))
+
+    def _fetch_endpoint(self, params):
+        if not self._page_size and not self._stream_results:
+            return self._show(self._endpoint, params=params)
+
+        objects = OrderedDict()
+        start = 0
+        while True:
+            page_params = self._build_page_params(params, start) if self._page_size else params
+            known = len(objects)
+            if self._stream_results:
+                merged, response = self._stream_page(objects, page_params, start)
+            else:
+                response = self._show(self._endpoint, params=page_params)
+                merged = self._merge_page(objects, response, start)
+            if merged is None:
+                return response
+            if not self._page_size or self._is_last_page(objects, known, merged):
+                return {'results': list(objects.values())}
+            start += self._page_size
+
+    def _stream_page(self, objects, params, start):
+        # the results array is decoded from the socket one object at a time,
+        # so the raw response body is never held in memory as a whole. The
+        # objects are indexed and compared once the table is complete, as
+        # deletes and moves depend on the whole table.
+        response = self._get(self._endpoint, params=self._build_params(params), stream=True)
+        response.raw.decode_content = True
+        stream = self._start_stream(start)
         try:
-            self._fortigate_current_config = self._show(self._endpoint)['results']
+            for prefix, event, value in ijson.parse(response.raw, use_float=True):
+                self._handle_stream_event(stream, objects, prefix, event, value)
+        except ijson.JSONError:
+            self.fail("Empty response received from endpoint %s for API._stream_page" % self._endpoint)
+        except (IOError, requests.packages.urllib3.exceptions.HTTPError) as e:
+            self.fail("Connection to API endpoint %s failed while streaming results: %s" % (self._endpoint, e))
+        finally:
+            response.close()
+        return stream['merged'], stream['envelope']
+
+    def _start_stream(self, start):
+        return {'start': start, 'envelope': {}, 'merged': None, 'builder': None}
+
+    def _handle_stream_event(self, stream, objects, prefix, event, value):
+        # merges every object of the results array into objects as soon as
+        # it is complete, the top-level scalars go to the envelope
+        builder = stream['builder']
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'results.item' and event in ('end_map', 'end_array'):
+                self._merge_object(objects, builder.value, stream['start'] + stream['merged'])
+                stream['merged'] += 1
+                stream['builder'] = None
+            elif prefix == 'results' and event == 'end_map':
+                stream['envelope']['results'] = builder.value  # single object endpoint
+                stream['builder'] = None
+        elif prefix == 'results' and event == 'start_array':
+            stream['merged'] = 0
+        elif (prefix == 'results' and event == 'start_map') or \
+                (prefix == 'results.item' and event in ('start_map', 'start_array')):
+            stream['builder'] = ObjectBuilder()
+            stream['builder'].event(event, value)
+        elif '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+            stream['envelope'][prefix] = value
+
+    def _response_cache_key(self, path, params):
+        return path, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+
+    def _get_cached_response(self, path, params):
+        # endpoint reads are cached for the rest of the run until a write
+        # under the same path invalidates them
+        cached_response = self._response_cache.get(self._response_cache_key(path, params))
+        if cached_response is None:
+            return None
+        return self._copy_response(cached_response)
+
+    def _cache_response(self, path, params, response):
+        if isinstance(response, dict) and 'results' in response:
+            self._response_cache[self._response_cache_key(path, params)] = self._copy_response(response)
+        return response
+
+    def _copy_response(self, response):
+        # callers reorder and rebuild the results list (policy moves,
+        # deletes) but never modify the objects in it, so only the list is
+        # copied; the objects are shared and large tables are not duplicated
+        response = dict(response)
+        if isinstance(response['results'], list):
+            response['results'] = list(response['results'])
+        elif isinstance(response['results'], dict):
+            response['results'] = dict(response['results'])
+        return response
+
+    def _invalidate_cached_responses(self, path):
+        if isinstance(path, list):
+            path = '/'.join(path)
+        path = path.split('?')[0].rstrip('/')
+        for key in list(self._response_cache):
+            cached_path = key[0].rstrip('/')
+            if cached_path.startswith(path) or path.startswith(cached_path):
+                self._response_cache.pop(key, None)
+
+    def _build_page_params(self, params, start):
+        page_params = dict(params or {})
+        page_params['start'] = start
+        page_params['count'] = self._page_size
+        return page_params
+
+    def _merge_page(self, objects, response, start):
+        # pages are merged by identifier as they arrive, so an object that
+        # shifts between pages while paging is only kept once
+        try:
+            results = response['results']
+        except KeyError:
+            return None
+        if not isinstance(results, list):
+            return None
+        for i, forti_object in enumerate(results):
+            self._merge_object(objects, forti_object, start + i)
+        return len(results)
+
+    def _is_last_page(self, objects, known, merged):
+        # a short page ends the table. Endpoints that ignore start and count
+        # return the whole table on every request, which shows as a page
+        # longer than page_size or as one that adds no new object.
+        return merged != self._page_size or len(objects) == known
+
+    def _merge_object(self, objects, forti_object, position):
+        if self._object_identifier and self._object_identifier in forti_object:
+            objects[forti_object[self._object_identifier]] = forti_object
+        else:
+            objects[position] = forti_object
+
+    def _build_fetch_params(self):
+        # returns the query parameters for every request needed to fetch the
+        # current configuration, one request unless the fetch is filtered
+        params = self._build_base_fetch_params()
+        filters = self._build_identifier_filters()
+        if not filters:
+            return [params or None]
+        return self._build_filtered_fetch_params(params, filters)
+
+    def _build_base_fetch_params(self):
+        params = {}
+        fields = self._get_managed_fields()
+        if fields:
+            params['format'] = '|'.join(fields)
+        if self._exclude_default_values:
+            params['exclude-default-values'] = 1
+        return params
+
+    def _build_filtered_fetch_params(self, params, filters):
+        fetch_params = []
+        for id_filter in filters:
+            batch_params = dict(params)
+            batch_params['filter'] = id_filter
+            fetch_params.append(batch_params)
+        return fetch_params
+
+    def _build_identifier_filters(self):
+        # with full_config disabled only the objects in the update list and
+        # delete_objects matter, so ask the device for those objects only
+        if self._full_config or not self._object_identifier or not isinstance(self._update_config, list):
+            return None
+        try:
+            object_ids = [o[self._object_identifier] for o in self._update_config]
+        except KeyError:
+            return None
+        seen_ids = set(object_ids)
+        for obj_id in list(self._delete_objects or []) + self._permanent_object_ids:
+            if obj_id not in seen_ids:
+                seen_ids.add(obj_id)
+                object_ids.append(obj_id)
+        return self._batch_identifier_filters(object_ids)
+
+    def _batch_identifier_filters(self, object_ids):
+        if not object_ids:
+            return None
+        if any(',' in str(obj_id) or '\\' in str(obj_id) for obj_id in object_ids):
+            return None  # characters with a meaning in filter syntax, fall back to a full fetch
+
+        filters = []
+        for i in range(0, len(object_ids), self._filter_batch_size):
+            batch = object_ids[i:i + self._filter_batch_size]
+            filters.append(','.join('%s==%s' % (self._object_identifier, obj_id) for obj_id in batch))
+        return filters
+
+    def _merge_fetch_responses(self, responses):
+        if len(responses) == 1:
+            return responses[0]
+        results = []
+        for response in responses:
+            try:
+                results.extend(response['results'])
+            except KeyError:
+                return response
+        return {'results': results}
+
+    def _get_managed_fields(self):
+        # union of the keys present in the update config, plus the identifier,
+        # so the device only sends back the attributes the module compares
+        if not self._fetch_managed_fields_only or not self._update_config:
+            return None
+        update_config = self._update_config
+        if isinstance(update_config, dict):
+            update_config = [update_config]
+        fields = set()
+        for forti_object in update_config:
+            fields.update(forti_object.keys())
+        if self._permanent_object_ids:
+            fields.update(self._default_object_configuration.keys())
+        if self._object_identifier:
+            fields.add(self._object_identifier)
+        return sorted(fields)
+
+    def _set_current_configuration(self, response):
+        try:
+            self._fortigate_current_config = response['results']
         except KeyError:
             self.fail("Failed to find any configuration at %s" %
                       self._endpoint)
 
         if self._fortigate_original_config is None:
-            self._fortigate_original_config = deepcopy(self._fortigate_current_config)
+            # kept with its default valued attributes, so comparing against it
+            # and rolling back to it covers attributes that were at defaults
+            self._fortigate_original_config = deepcopy(self._expand_configuration(self._fortigate_current_config))
             if self._print_current_config:
                 file_name = self._endpoint.replace('/', '-') + '-CurrentConfig.json'
                 json.dump({"current": self._fortigate_current_config}, open(file_name, 'w+'), indent=4, sort_keys=True)
 
         if isinstance(self._fortigate_current_config, list):
             try:
-                self._used_object_ids = [o[self._object_identifier] for o in self._update_config]
-                self._existing_object_ids = [o[self._object_identifier] for o in self._fortigate_current_config]
+                self._used_object_ids = set(o[self._object_identifier] for o in self._update_config)
+                self._current_config_index = self._index_objects(self._fortigate_current_config)
             except KeyError:
                 self.fail("No or incorrect object identifier specified. List endpoints require an object identifier, typically name or id.")
 
+    def _clear_endpoint(self):
+        if not self._delete_all_objects():
+            return False
+        self._touched_object_ids = None
+        self._remove(self._endpoint)
+        self._get_current_configuration()
+        return True
+
     def _delete_unused_objects(self):
-        if not self._update_config and not self._check_mode and self._full_config:
-            self._remove(self._endpoint)
-            self._get_current_configuration()
+        unused_objects = self._change_plan.deletes
+        if self._check_mode:
+            self._remove_objects_from_current_config(unused_objects)
+            return
+
+        self._process_delete_responses(unused_objects, self._run_concurrently(self._remove_object, unused_objects))
 
+    def _delete_all_objects(self):
+        return not self._update_config and not self._check_mode and self._full_config
+
+    def _get_unused_object_ids(self):
         if self._full_config:
-            unused_objects = [identifier for identifier in self._existing_object_ids
+            unused_objects = [identifier for identifier in self._current_config_index
                           if identifier not in self._used_object_ids and
-                          identifier not in self._permanent_object_ids and
+                          identifier not in self._permanent_object_id_set and
                           identifier not in self._ignore_object_ids]
         else:
+            # delete_objects may name objects the device does not have
+            existing_object_ids = set(str(identifier) for identifier in self._current_config_index)
             unused_objects = [identifier for identifier in self._delete_objects
-                          if identifier not in self._used_object_ids and
-                          identifier not in self._permanent_object_ids and
+                          if str(identifier) in existing_object_ids and
+                          identifier not in self._used_object_ids and
+                          identifier not in self._permanent_object_id_set and
                           identifier not in self._ignore_object_ids]
+        return unused_objects
 
+    def _process_delete_responses(self, unused_objects, responses):
         failures = {}
-        for object_identifier in unused_objects:
-            if not self._full_config and not self._check_mode:
-                response = self._remove(
-                    '/'.join([self._endpoint, str(object_identifier)]))
-                if response['http_status'] == 200:
-                    self._remove_object_from_current_config(object_identifier)
-                elif response['http_status'] == 404:
-                    continue #trying to remove object that doesn't exist, no actions needed
-                else:
-                    failures[object_identifier] = self.http_status_codes[
-                        response['http_status']]
-            elif not self._check_mode:
-                response = self._remove(
-                    '/'.join([self._endpoint, str(object_identifier)]))
-                if response['http_status'] == 200:
-                    self._remove_object_from_current_config(object_identifier)
-                else:
-                    failures[object_identifier] = self.http_status_codes[
-                        response['http_status']]
+        removed_objects = []
+        self._mark_touched(unused_objects)
+        for object_identifier, response in zip(unused_objects, responses):
+            if response['http_status'] == 200:
+                removed_objects.append(object_identifier)
+            elif response['http_status'] == 404 and not self._full_config:
+                continue #trying to remove object that doesn't exist, no actions needed
             else:
-                self._remove_object_from_current_config(object_identifier)
+                failures[object_identifier] = self.http_status_codes[
+                    response['http_status']]
+        self._remove_objects_from_current_config(removed_objects)
 
         if failures:
             self.fail("Failed to delete objects:\n ", msg_args=failures)
 
-    def _remove_object_from_current_config(self, object_identifier):
-        for i, forti_object in enumerate(self._fortigate_current_config):
-            if forti_object[self._object_identifier] == object_identifier:
-                del self._fortigate_current_config[i]
-                return
+    def _remove_objects_from_current_config(self, object_identifiers):
+        # drop the objects from the index first and rebuild the list once,
+        # rather than scanning the list for every removed object
+        removed = False
+        for object_identifier in object_identifiers:
+            if self._current_config_index.pop(object_identifier, None) is not None:
+                removed = True
+        if removed:
+            self._fortigate_current_config = list(self._current_config_index.values())
 
-    def _update_objects(self):
-        matching_objects = [o[self._object_identifier] for o in self._update_config if o[self._object_identifier] in self._existing_object_ids and
-                            not self._diff_unknown(self._get_current_object(o), o)]
-        self._object_ids_to_update = [o[self._object_identifier] for o in self._update_config if o[self._object_identifier] in self._existing_object_ids and
-                                      o[self._object_identifier] not in matching_objects]
-        if self._update_config:
-            self._permanent_object_ids_to_reset = [obj_id for obj_id in self._permanent_object_ids if obj_id not in self._object_ids_to_update and
-                                               obj_id not in matching_objects]
-        else:
-            self._permanent_object_ids_to_reset = [obj_id for obj_id in self._permanent_object_ids if obj_id in self._delete_objects and
-                                                obj_id not in self._object_ids_to_update and obj_id not in matching_objects]
+    def _index_objects(self, objects):
+        return OrderedDict((o[self._object_identifier], o) for o in objects)
 
+    def _update_objects(self):
         failures = {}
         self._update_temporary_and_permanent_objects(failures)
         self._reset_permanent_objects(failures)
+        self._check_update_failures(failures)
+
+    def _mark_touched(self, object_identifiers):
+        # objects sent to the device, re-read by targeted verification
+        if self._touched_object_ids is not None:
+            for object_identifier in object_identifiers:
+                self._touched_object_ids[object_identifier] = True
+
+    def _permanent_object_drifted(self, object_identifier):
+        # permanent objects already at their defaults are not reset again
+        current_object = self._current_config_index.get(object_identifier)
+        if current_object is None:
+            return True
+        return not self._objects_match(self._expand_defaults(current_object), self._build_reset_object(object_identifier))
+
+    def _check_update_failures(self, failures):
         if failures:
             failures_string = ""
             for k, v in failures.items():
@@ -470,59 +884,137 @@ class API(object):
             self.fail("Failed to update objects:\n " + failures_string)
 
     def _update_temporary_and_permanent_objects(self, failures):
-        update_objects = [o for o in self._update_config if o[
-            self._object_identifier] in self._object_ids_to_update]
-        for forti_object in update_objects:
-            if not self._check_mode:
-                response = self._edit(
-                    self._endpoint + "/%s" % str(forti_object[self._object_identifier]), data=forti_object)
-                if response['http_status'] != 200:
-                    failures[forti_object[self._object_identifier]
-                             ] = self.http_status_codes[response['http_status']]
+        update_objects = self._get_objects_to_update()
+        if not self._check_mode:
+            self._collect_failures(update_objects, self._run_concurrently(
+                self._edit_object, update_objects), failures)
+
+    def _get_objects_to_update(self):
+        return [payload for payload, delta in self._change_plan.updates.values()]
+
+    def _build_update_payload(self, forti_object):
+        # only the attributes that differ from the current object are sent,
+        # tables are sent whole as FortiOS replaces them as a unit
+        current_object = self._get_current_object(forti_object)
+        if current_object is None:
+            return forti_object
+        payload = {self._object_identifier: forti_object[self._object_identifier]}
+        for key, update_val in forti_object.items():
+            if key in current_object:
+                shape = self._object_shape(update_val)
+                if self._fingerprint(current_object[key], shape, key=key) == \
+                        self._fingerprint(update_val, shape, key=key) and \
+                        self._values_match(current_object[key], update_val, key):
+                    continue
+            payload[key] = update_val
+        return payload
 
     def _reset_permanent_objects(self, failures):
-        for identifier in self._permanent_object_ids_to_reset:
-            response_data = deepcopy(self._default_object_configuration)
-            response_data[self._object_identifier] = identifier
-            if not self._check_mode:
-                response = self._edit(self._endpoint + "/%s" %
-                                      str(identifier), data=response_data)
-                if response['http_status'] != 200:
-                    failures[identifier] = self.http_status_codes[
-                        response['http_status']]
+        reset_objects = self._get_objects_to_reset()
+        if not self._check_mode:
+            self._collect_failures(reset_objects, self._run_concurrently(
+                self._edit_object, reset_objects), failures)
+
+    def _get_objects_to_reset(self):
+        return list(self._change_plan.resets.values())
+
+    def _build_reset_object(self, identifier):
+        response_data = deepcopy(self._default_object_configuration)
+        response_data[self._object_identifier] = identifier
+        return response_data
 
     def _get_current_object(self, forti_object):
-        for obj in self._fortigate_current_config:
-            if obj[self._object_identifier] == forti_object[self._object_identifier]:
-                return obj
-        return None
+        obj = self._current_config_index.get(forti_object[self._object_identifier])
+        if obj is None:
+            return None
+        return self._expand_defaults(obj)
+
+    def _expand_configuration(self, config):
+        if isinstance(config, list):
+            return [self._expand_defaults(o) for o in config]
+        return self._expand_defaults(config)
+
+    def _expand_defaults(self, forti_object):
+        # objects fetched with exclude_default_values lack every attribute
+        # that is at its default, fill them in before comparing
+        if not self._exclude_default_values or not isinstance(forti_object, dict):
+            return forti_object
+        expanded = dict(self._device_default_object)
+        expanded.update(forti_object)
+        return expanded
 
     def _create_new_objects(self):
         if not self._update_config:
             return
-        existing_object_ids = [o[self._object_identifier]
-                               for o in self._fortigate_current_config]
-        new_objects = [o for o in self._update_config if o[self._object_identifier] not in existing_object_ids and
-                       o[self._object_identifier] not in self._permanent_object_ids]
+        new_objects = self._get_new_objects()
         failures = {}
-        for forti_object in new_objects:
-            if not self._check_mode:
-                response = self._create(self._endpoint, data=forti_object)
-                if response['http_status'] != 200:
-                    failures[forti_object[self._object_identifier]
-                             ] = self.http_status_codes[response['http_status']]
+        if not self._check_mode:
+            self._collect_failures(new_objects, self._run_concurrently(
+                self._create_object, new_objects), failures)
+        self._check_create_failures(failures)
+
+    def _get_new_objects(self):
+        return list(self._change_plan.creates)
+
+    def _check_create_failures(self, failures):
         if failures:
             self.fail("Failed to create objects:\n ", msg_args=failures)
 
+    def _remove_object(self, object_identifier):
+        return self._remove('/'.join([self._endpoint, str(object_identifier)]))
+
+    def _edit_object(self, forti_object):
+        return self._edit(self._endpoint + "/%s" % str(forti_object[self._object_identifier]), data=forti_object)
+
+    def _create_object(self, forti_object):
+        return self._create(self._endpoint, data=forti_object)
+
+    def _collect_failures(self, forti_objects, responses, failures):
+        for forti_object, response in zip(forti_objects, responses):
+            if response['http_status'] != 200:
+                failures[forti_object[self._object_identifier]
+                         ] = self.http_status_codes[response['http_status']]
+
+    def _run_concurrently(self, func, items):
+        # results are returned in the order of items regardless of the order
+        # in which the requests complete, so callers stay deterministic
+        if self._max_concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        def run_item(item):
+            try:
+                return func(item), None
+            except BaseException as e:
+                return None, e
+
+        pool = ThreadPool(min(self._max_concurrency, len(items)))
+        try:
+            outcomes = pool.map(run_item, items)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = []
+        for result, error in outcomes:
+            if error is not None:
+                raise error
+            results.append(result)
+        return results
+
     def _update_single_object_endpoint(self):
+        if not self._check_mode and self._change_plan.updates:
+            self._edit(self._endpoint, data=self._update_config)
 
+    def _select_single_object_update(self):
         if self._update_config and isinstance(self._update_config, list):
             self._update_config = self._update_config[0]
-        else:
+        elif not self._update_config:
             self._update_config = self._default_object_configuration
 
-        if not self._check_mode:
-            self._edit(self._endpoint, data=self._update_config)
+    def _single_object_update_needed(self):
+        # every PUT makes FortiOS save the config and bump its revision, so
+        # nothing is sent when the endpoint already matches
+        return not self._objects_match(self._expand_defaults(self._fortigate_current_config), self._update_config)
 
     def __enter__(self):
         return self
@@ -532,50 +1024,134 @@ class API(object):
             self._logout()
         except AttributeError:
             pass
+        try:
+            self._session.close()
+        except AttributeError:
+            pass
 
     def __exit__(self, *args):
         pass
 
+    def _authenticate(self):
+        if self._api_key:
+            # token is sent with every request, there is no session to set up
+            self._session.headers['Authorization'] = 'Bearer %s' % self._api_key
+            self.cookies = None
+            self.header = self._set_csrf_header()
+            return
+
+        conn_params = self._params['conn_params']
+        if not conn_params.get('fortigate_username') or conn_params.get('fortigate_password') is None:
+            self.fail("Either api_key or both fortigate_username and fortigate_password are required in conn_params.")
+
+        if self._load_cached_session():
+            return
+
+        response = self._login()
+        self.cookies = response.cookies
+        self.header = self._set_csrf_header()
+
+        if not response.cookies:
+            self.fail(
+                "Authentication failed. Authentication attempts likely blocked temporarily.")
+        if "just_logged_in" in response.cookies:
+            self.fail(
+                "Authentication with FortiOS device failed. Check your username/password.")
+
+        self._store_cached_session()
+
+    def _session_cache_key(self):
+        return '|'.join([self._ip, str(self._params['conn_params'].get('fortigate_username')), str(self._vdom)])
+
+    def _read_session_cache(self, cache_file):
+        try:
+            cache = json.load(cache_file)
+        except ValueError:
+            cache = {}
+        if not isinstance(cache, dict):
+            cache = {}
+        return cache
+
+    def _load_cached_session(self):
+        if not self._session_cache_file:
+            return False
+        try:
+            with open(self._session_cache_file, 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                cached_session = self._read_session_cache(f).get(self._session_cache_key())
+        except IOError:
+            return False
+        if not cached_session:
+            return False
+
+        self.cookies = requests.utils.cookiejar_from_dict(cached_session.get('cookies', {}))
+        self.header = cached_session.get('header')
+        # one cheap request proves the cached cookies are still accepted,
+        # anything but 401 means there is no need to go through /logincheck
+        response = self._get('monitor/system/status', params=self._build_params(None))
+        return response.status_code != 401
+
+    def _store_cached_session(self):
+        if not self._session_cache_file:
+            return
+        try:
+            fd = os.open(self._session_cache_file, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                cache = self._read_session_cache(f)
+                cache[self._session_cache_key()] = {
+                    'cookies': requests.utils.dict_from_cookiejar(self.cookies),
+                    'header': self.header}
+                f.seek(0)
+                f.truncate()
+                json.dump(cache, f, indent=4, sort_keys=True)
+        except (IOError, OSError) as e:
+            self.fail("Failed to write session cache %s: %s" % (self._session_cache_file, e))
+
     @connection_handler
     def _login(self):
+        if self._api_key:
+            return None
         data = {'username': self._params['conn_params']['fortigate_username'],
                 'secretkey': self._params['conn_params']['fortigate_password']}
-        return requests.post(self._ip + '/logincheck', data=data, verify=self._verify, proxies=self.proxies)
+        return self._session.post(self._ip + '/logincheck', data=data, verify=self._verify, proxies=self.proxies)
 
     @connection_handler
     def _logout(self):
-        requests.post(self._ip + '/logout', cookies=self.cookies,
-                      verify=self._verify, proxies=self.proxies)
+        if self._api_key or self._session_cache_file:
+            return  # the session stays valid for the next task that reads the cache
+        self._session.post(self._ip + '/logout', cookies=self.cookies,
+                           verify=self._verify, proxies=self.proxies)
 
     @connection_handler
-    def _get(self, path, api='v2', params=None):
+    def _get(self, path, api='v2', params=None, stream=False):
         if isinstance(path, list):
             path = '/'.join(path) + '/'
-        return requests.get(self._ip + '/api/' + api + '/' + path, cookies=self.cookies, verify=self._verify,
-                            proxies=self.proxies, params=params)
+        return self._session.get(self._ip + '/api/' + api + '/' + path, cookies=self.cookies, verify=self._verify,
+                                 proxies=self.proxies, params=params, stream=stream)
 
     @connection_handler
     def _put(self, path, api='v2', params=None, data=None):
         if isinstance(path, list):
             path = '/'.join(path) + '/'
-        return requests.put(self._ip + '/api/' + api + '/' + path, headers=self.header,
-                            cookies=self.cookies, verify=self._verify, proxies=self.proxies, params=params,
-                            json={'json': data})
+        return self._session.put(self._ip + '/api/' + api + '/' + path, headers=self.header,
+                                 cookies=self.cookies, verify=self._verify, proxies=self.proxies, params=params,
+                                 json={'json': data})
 
     @connection_handler
     def _post(self, path, api='v2', params=None, data=None):
         if isinstance(path, list):
             path = '/'.join(path) + '/'
-        return requests.post(self._ip + '/api/' + api + '/' + path, headers=self.header, cookies=self.cookies,
-                             verify=self._verify, proxies=self.proxies, params=params, json={'json': data})
+        return self._session.post(self._ip + '/api/' + api + '/' + path, headers=self.header, cookies=self.cookies,
+                                  verify=self._verify, proxies=self.proxies, params=params, json={'json': data})
 
     @connection_handler
     def _delete(self, path, api='v2', params=None, data=None):
         if isinstance(path, list):
             path = '/'.join(path) + '/'
-        return requests.delete(self._ip + '/api/' + api + '/' + path, headers=self.header,
-                               cookies=self.cookies, verify=self._verify, proxies=self.proxies, params=params,
-                               json={'json': data})
+        return self._session.delete(self._ip + '/api/' + api + '/' + path, headers=self.header,
+                                    cookies=self.cookies, verify=self._verify, proxies=self.proxies, params=params,
+                                    json={'json': data})
 
     @return_handler
     def _show(self, path, api='v2', params=None):
@@ -583,14 +1159,17 @@ class API(object):
 
     @return_handler
     def _edit(self, path, api='v2', params=None, data=None):
+        self._invalidate_cached_responses(path)
         return self._put(path, api=api, params=self._build_params(params), data=data).json()
 
     @return_handler
     def _create(self, path, api='v2', params=None, data=None):
+        self._invalidate_cached_responses(path)
         return self._post(path, api=api, params=self._build_params(params), data=data).json()
 
     @return_handler
     def _remove(self, path, api='v2', params=None, data=None):
+        self._invalidate_cached_responses(path)
         return self._delete(path, api=api, params=self._build_params(params), data=data).json()
 
     def _build_params(self, new_params):
@@ -742,6 +1321,14 @@ class API(object):
             self.fail("Couldn't find type with key %s" % type_str)
 
     def _get_default_object(self):
+        default_object = deepcopy(self._device_default_object)
+        for k in self._api_info.get('default_ignore_params', []):
+            if k in default_object:
+                del default_object[k]
+
+        return default_object
+
+    def _get_device_default_object(self):
         local_specification = self._get_local_spec()
         if local_specification is None:
             local_specification = {}
@@ -769,18 +1356,27 @@ class API(object):
             default_object = local_specification[
                 self._endpoint]['default_object']
 
-        for k in self._api_info.get('default_ignore_params', []):
-            if k in default_object:
-                del default_object[k]
-
         return default_object
 
     def _set_csrf_header(self):
+        if self._api_key:
+            return None
         for cookie in self.cookies:
             if cookie.name == "ccsrftoken":
                 csrftoken = cookie.value[1:-1]
                 return {"X-CSRFTOKEN": csrftoken}
 
+    def _build_session(self):
+        # a single keep-alive session is shared by every verb, so TCP and TLS
+        # connections to the device are reused instead of set up per request
+        pool_size = max(int(self._params['conn_params'].get('pool_size') or 10), self._max_concurrency)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
     def _build_target_ip(self):
         if self._secure:
             port = self._params['conn_params'].get('port', 443)
@@ -791,15 +1387,56 @@ class API(object):
         return "%s%s:%i" % (string, self._params['conn_params']['fortigate_ip'], port)
 
     def _process_response(self):
+        verification_params = self._build_verification_params()
+        if verification_params is None:
+            self._get_current_configuration()
+        else:
+            self._set_verified_configuration(self._run_concurrently(self._show_endpoint, verification_params))
+        result = self._evaluate_applied_configuration()
+        if result is None:
+            self._rollback_config()
+            self._report_rollback()
+        return result
+
+    def _build_verification_params(self):
+        # with targeted verification only the objects that were sent to the
+        # device are read back, None means the whole endpoint is fetched
+        if not self._targeted_verification or self._touched_object_ids is None:
+            return None
+        if not isinstance(self._fortigate_current_config, list):
+            return None
+        if not self._touched_object_ids:
+            return []
+        filters = self._batch_identifier_filters(list(self._touched_object_ids))
+        if not filters:
+            return None
+        return self._build_filtered_fetch_params(self._build_base_fetch_params(), filters)
+
+    def _set_verified_configuration(self, responses):
+        verified_objects = {}
+        for response in responses:
+            try:
+                verified_objects.update(self._index_objects(response['results']))
+            except (KeyError, TypeError):
+                self.fail("Failed to find any configuration at %s" % self._endpoint)
+
+        objects = OrderedDict(self._current_config_index)
+        for object_identifier in self._touched_object_ids:
+            if object_identifier in verified_objects:
+                objects[object_identifier] = verified_objects[object_identifier]
+            else:
+                objects.pop(object_identifier, None)
+        self._set_current_configuration({'results': list(objects.values())})
+
+    def _evaluate_applied_configuration(self):
+        # returns None when the device matches neither the original nor the
+        # updated configuration and the caller has to roll back
         success_msg = "Configuration updated."
         not_applied_msg = """Configuration update could not be applied, but the FortiOS API generated no errors.
                              This is generally the result of attempting to make changes that cannot affect the current configuration."""
         no_change_needed_msg = "Configuration already correct, no changes needed."
         default_failed_msg = "Default configuration applied but not currently matched by the device."
-        rollback_msg = "Update failed, successfully rolled back to original configuration."
-        intermediate_msg = "Configuration update failed and rollback failed, configuration appears to be in a partially applied state."
 
-        self._get_current_configuration()
         matches_original_config, matches_update_config = self._original_or_update_match_current_configuration()
 
         default_applied = not self._update_config
@@ -814,15 +1451,20 @@ class API(object):
             message = not_applied_msg
         # not matches_original_config and not matches_update_config
         else:
-            self._rollback_config()
-            matches_original_config, matches_update_config = self._original_or_update_match_current_configuration()
-            if matches_original_config:
-                self.fail(rollback_msg)
-            else:
-                self.fail(intermediate_msg)
+            return None
 
         return message, not matches_original_config, not matches_update_config
 
+    def _report_rollback(self):
+        rollback_msg = "Update failed, successfully rolled back to original configuration."
+        intermediate_msg = "Configuration update failed and rollback failed, configuration appears to be in a partially applied state."
+
+        matches_original_config, matches_update_config = self._original_or_update_match_current_configuration()
+        if matches_original_config:
+            self.fail(rollback_msg)
+        else:
+            self.fail(intermediate_msg)
+
     def _original_or_update_match_current_configuration(self):
         if isinstance(self._fortigate_current_config, list):
             if len(self._fortigate_current_config) > len(self._fortigate_original_config):
@@ -836,11 +1478,11 @@ class API(object):
             matches_original_config = self._configurations_match(
                 self._fortigate_current_config, self._fortigate_original_config)
             if isinstance(self._fortigate_current_config, dict) and self._update_config:
-                matches_update_config = self._dictionaries_match(
-                    self._fortigate_current_config, self._update_config)
+                matches_update_config = self._objects_match(
+                    self._expand_defaults(self._fortigate_current_config), self._update_config)
             elif isinstance(self._fortigate_current_config, dict) and not self._update_config:
-                matches_update_config = self._dictionaries_match(
-                    self._fortigate_current_config, self._default_object_configuration)
+                matches_update_config = self._objects_match(
+                    self._expand_defaults(self._fortigate_current_config), self._default_object_configuration)
         return matches_original_config, matches_update_config
 
     def _rollback_config(self):
@@ -848,8 +1490,15 @@ class API(object):
         self._update_config = self._fortigate_original_config
         self._execute_config_changes()
         self._update_config = temp
+        # the rollback result is judged on what the device holds afterwards
+        self._get_current_configuration()
 
     def fail(self, msg, msg_args=None):
+        with self._fail_lock:
+            if getattr(self, '_failed', False):
+                # another worker thread already reported the failure
+                raise SystemExit(1)
+            self._failed = True
         try:
             self._logout()
         except:
@@ -877,30 +1526,28 @@ class API(object):
             return False
 
         if isinstance(update_config, dict):
-            if not self._dictionaries_match(current_config, update_config):
+            if not self._objects_match(current_config, update_config):
                 return False
 
         elif isinstance(update_config, list):
-            if not self._lists_match(current_config, update_config):
+            if not self._object_lists_match(current_config, update_config):
                 return False
 
         return True
 
     def _setup_configs_for_diff(self, current_config, update_config):
         if isinstance(current_config, dict):
+            current_config = self._expand_defaults(current_config)
             objects_only_in_update_config = {}
         else:
             update_object_ids = [o[self._object_identifier]
                                  for o in update_config]
-            check_current_matches = [o for o in current_config if o[
-                self._object_identifier] in update_object_ids]
-            current_match_ids = [o[self._object_identifier]
-                                 for o in check_current_matches]
-            objects_only_in_update_config = [o for o in update_config if o[self._object_identifier] not in current_match_ids and
-                                             o[self._object_identifier] not in self._permanent_object_ids]
+            current_index = self._index_objects(current_config)
+            objects_only_in_update_config = [o for o in update_config if o[self._object_identifier] not in current_index and
+                                             o[self._object_identifier] not in self._permanent_object_id_set]
             if update_config:
-                current_config = [self._get_object_from_list_by_id(
-                    current_config, obj_id) for obj_id in update_object_ids]
+                current_config = [self._expand_defaults(current_index.get(obj_id))
+                                  for obj_id in update_object_ids]
 
         return current_config, update_config, objects_only_in_update_config
 
@@ -924,74 +1571,304 @@ class API(object):
 
     def _dictionaries_match(self, current_config, update_config):
         for key, val in update_config.items():
-            current_val = current_config.get(key)
+            if not self._values_match(current_config.get(key), val, key):
+                return False
+
+        return True
 
-            if isinstance(val, dict):
-                if not self._dictionaries_match(current_val, val):
+    def _values_match(self, current_val, val, key):
+        if isinstance(val, dict):
+            return self._dictionaries_match(current_val, val)
+        elif isinstance(val, list):
+            return self._lists_match(current_val, val, key)
+        return val == current_val or key in self._match_ignore_params
+
+    def _objects_match(self, current_object, update_object):
+        return self._match_object(self, current_object, update_object)
+
+    def _diff_objects(self, current_object, update_object):
+        # same result as _diff_unknown for a pair of objects
+        diff = self._diff_object(self, current_object, update_object)
+        if diff and any(diff.values()):
+            return diff
+        return None
+
+    def _get_comparators(self, arg_spec):
+        key = (self._endpoint, frozenset(self._match_ignore_params), frozenset(self._ordered_list_params))
+        comparators = _compiled_comparators.get(key)
+        if comparators is None:
+            comparators = self._compile_object_comparators(arg_spec)
+            _compiled_comparators[key] = comparators
+        return comparators
+
+    def _compile_object_comparators(self, arg_spec):
+        # _dictionaries_match and _diff_dicts specialized for the fields of
+        # the arg spec: types, tables and ignored fields are resolved once
+        # here instead of for every value compared. Fields missing from the
+        # spec and values of unexpected types go through the generic
+        # functions, the compiled functions take the API instance to reach them.
+        ignore_params = frozenset(self._match_ignore_params)
+        match_fields = {}
+        diff_fields = {}
+        for key, spec in arg_spec.items():
+            options = spec.get('options')
+            if isinstance(options, dict) and spec.get('type') == 'dict':
+                match_fields[key], diff_fields[key] = self._compile_dict_field(
+                    key, *self._compile_object_comparators(options))
+            elif isinstance(options, dict) and spec.get('type') == 'list':
+                match_fields[key], diff_fields[key] = self._compile_table_field(
+                    key, key in self._ordered_list_params, *self._compile_object_comparators(options))
+            else:
+                match_fields[key], diff_fields[key] = self._compile_scalar_field(key, key in ignore_params)
+
+        def match_object(api, current_object, update_object):
+            for key, val in update_object.items():
+                match_field = match_fields.get(key)
+                if match_field is None:
+                    if not api._values_match(current_object.get(key), val, key):
+                        return False
+                elif not match_field(api, current_object.get(key), val):
                     return False
+            return True
 
-            elif isinstance(val, list):
-                if not self._lists_match(current_val, val):
+        def diff_object(api, current_object, update_object):
+            diff = {}
+            for key, update_val in update_object.items():
+                if key in current_object:
+                    diff_field = diff_fields.get(key)
+                    if diff_field is None:
+                        sub_val = api._diff_unknown(current_object[key], update_val, key)
+                    else:
+                        sub_val = diff_field(api, current_object[key], update_val)
+                    if sub_val is not False:
+                        diff[key] = sub_val
+                elif key not in ignore_params:
+                    diff[key] = update_val
+            return diff or None
+
+        return match_object, diff_object
+
+    def _compile_scalar_field(self, key, ignored):
+        def match_field(api, current_val, val):
+            if isinstance(val, (dict, list)):
+                return api._values_match(current_val, val, key)
+            return ignored or val == current_val
+
+        def diff_field(api, current_val, val):
+            if isinstance(val, (dict, list)):
+                return api._diff_unknown(current_val, val, key)
+            return val if current_val != val else False
+
+        return match_field, diff_field
+
+    def _compile_dict_field(self, key, match_object, diff_object):
+        def match_field(api, current_val, val):
+            if isinstance(val, dict) and isinstance(current_val, dict):
+                return match_object(api, current_val, val)
+            return api._values_match(current_val, val, key)
+
+        def diff_field(api, current_val, val):
+            if isinstance(val, dict) and isinstance(current_val, dict):
+                diff = diff_object(api, current_val, val)
+                return diff if diff and any(diff.values()) else None
+            return api._diff_unknown(current_val, val, key)
+
+        return match_field, diff_field
+
+    def _compile_table_field(self, key, ordered, match_object, diff_object):
+        def match_field(api, current_val, val):
+            if not isinstance(val, list) or not isinstance(current_val, list) or len(current_val) != len(val):
+                return api._values_match(current_val, val, key)
+            if current_val == val:
+                return True
+            if not ordered:
+                return api._lists_match(current_val, val, key)
+            for current_element, element in zip(current_val, val):
+                if isinstance(element, dict) and isinstance(current_element, dict):
+                    if not match_object(api, current_element, element):
+                        return False
+                elif not api._unknown_types_match(current_element, element):
                     return False
+            return True
 
-            elif val != current_val and key not in self._match_ignore_params:
-                return False
+        def diff_element(api, current_element, element):
+            if isinstance(element, dict) and isinstance(current_element, dict):
+                diff = diff_object(api, current_element, element)
+                return diff if diff and any(diff.values()) else None
+            return api._diff_unknown(current_element, element)
+
+        def diff_field(api, current_val, val):
+            if not isinstance(val, list) or not isinstance(current_val, list):
+                return api._diff_unknown(current_val, val, key)
+            if len(current_val) != len(val):
+                diff = val
+            else:
+                diff = [diff_element(api, c, v) for c, v in zip(current_val, val)]
+                if not any(diff) or api._lists_match(current_val, val, key):
+                    diff = None
+            return diff if diff and any(diff) else None
 
-        return True
+        return match_field, diff_field
 
-    def _lists_match(self, current_config, update_config):
+    def _lists_match(self, current_config, update_config, key=None):
         if not isinstance(current_config, list) or len(update_config) != len(current_config) or current_config is None:
             return False
 
         if current_config == update_config:
             return True
 
-        for i, val in enumerate(update_config):
-            if val not in current_config and not self._unknown_types_match(current_config[i], val):
-                return False
+        if key in self._ordered_list_params:
+            for current_val, val in zip(current_config, update_config):
+                if not self._unknown_types_match(current_val, val):
+                    return False
+            return True
+
+        # elements are projected on the keys the update elements set and
+        # compared as multisets; update elements setting different keys
+        # fall back to pairing each with an unused current element
+        shape = self._match_shape(update_config)
+        if shape is False:
+            unused = list(current_config)
+            for val in update_config:
+                for i, current_val in enumerate(unused):
+                    if self._unknown_types_match(current_val, val):
+                        del unused[i]
+                        break
+                else:
+                    return False
+            return True
 
+        return self._fingerprint(update_config, shape, missing=None) == \
+            self._fingerprint(current_config, shape, missing=None)
+
+    def _freeze(self, value, key=None):
+        # hashable form of a projected value for in-memory comparison, lists
+        # are frozen as multisets unless their key is in ordered_list_params
+        if isinstance(value, dict):
+            return frozenset((k, self._freeze(v, k)) for k, v in value.items())
+        elif isinstance(value, list):
+            if key in self._ordered_list_params:
+                return tuple(self._freeze(v) for v in value)
+            return frozenset(Counter(self._freeze(v) for v in value).items())
+        return value
+
+    def _object_lists_match(self, current_config, update_config):
+        # current_config is aligned to update_config by _setup_configs_for_diff,
+        # so objects are compared pairwise instead of searching the whole list
+        if not isinstance(current_config, list) or len(update_config) != len(current_config):
+            return False
+        for current_object, update_object in zip(current_config, update_config):
+            if current_object is None or not self._objects_match(current_object, update_object):
+                return False
         return True
 
-    def _get_object_from_list_by_id(self, objects, obj_id):
-        for i in objects:
-            if i[self._object_identifier] == obj_id:
-                return i
+    def _object_shape(self, value):
+        # the shape of an update object is the tree of keys it sets, list
+        # elements are merged into one shape; a current object projected on
+        # that shape compares equal to the update object when the _diff
+        # functions find nothing to change. Like _diff_unknown, empty values
+        # in the update object match anything and are left out of the shape,
+        # values made of empty values only need the key to be present.
+        if isinstance(value, dict):
+            shape = {}
+            for k, v in value.items():
+                if k in self._match_ignore_params or not v:
+                    continue
+                shape[k] = '?' if self._matches_anything(v) else self._object_shape(v)
+            return shape
+        elif isinstance(value, list):
+            element_shape = None
+            for element in value:
+                element_shape = self._merge_shapes(element_shape, self._object_shape(element))
+            return [element_shape]
         return None
 
-    def _diff_configs(self, current=None, update=None):
-        # the _diff functions determine whether the given "current" object has
-        # all matching keys/values to the given "update" object
-        if current is None and update is None:
-            current = self._fortigate_current_config
-            update = self._update_config
-
-        if isinstance(current, list):
-            update_ids = [o[self._object_identifier] for o in update]
-            needed_objects = [o for o in current if o[
-                self._object_identifier] in update_ids]
-            update = sorted(update, key=lambda k: k[self._object_identifier])
-            current = sorted(needed_objects, key=lambda k: k[
-                             self._object_identifier])
-            diff = []
-            for i, update_val in enumerate(update):
-                try:
-                    sub_diff = self._diff_unknown(current[i], update_val)
-                except IndexError:
-                    sub_diff = None
-                if sub_diff and any([v for k, v in sub_diff.items()]):
-                    sub_diff[self._object_identifier] = update_val[
-                        self._object_identifier]
-                    diff.append(sub_diff)
-                elif sub_diff in ([], {}):
-                    diff.append(sub_diff)
-        elif isinstance(current, dict):
-            diff = self._diff_dicts(current, update)
-        else:
-            raise TypeError("Invalid type to diff: %s" % type(current))
+    def _match_shape(self, value):
+        # the shape _dictionaries_match compares: every key except ignored
+        # scalars, empty values included. Projected with missing=None, as
+        # _dictionaries_match takes a missing key for None. False when the
+        # elements of a list set different keys.
+        if isinstance(value, dict):
+            shape = {}
+            for k, v in value.items():
+                if isinstance(v, (dict, list)) or k not in self._match_ignore_params:
+                    shape[k] = self._match_shape(v)
+                    if shape[k] is False:
+                        return False
+            return shape
+        elif isinstance(value, list) and value:
+            shape = self._match_shape(value[0])
+            if shape is False or any(self._match_shape(v) != shape for v in value[1:]):
+                return False
+            return [shape]
+        return None
 
-        if diff and not any(diff):
-            diff = None
-        return diff
+    def _matches_anything(self, value):
+        if isinstance(value, dict):
+            return all(self._matches_anything(v) for k, v in value.items()
+                       if k not in self._match_ignore_params)
+        elif isinstance(value, list):
+            return not any(value)
+        return not value
+
+    def _merge_shapes(self, shape, other):
+        if isinstance(shape, dict) and isinstance(other, dict):
+            merged = dict(shape)
+            for k, v in other.items():
+                merged[k] = self._merge_shapes(merged.get(k), v)
+            return merged
+        elif isinstance(shape, list) and isinstance(other, list):
+            return [self._merge_shapes(shape[0], other[0])]
+        return other if shape is None else shape
+
+    def _project_to_shape(self, value, shape, missing=_MISSING):
+        # the one projection used for update payloads, policy matching and
+        # list matching; shapes come from _object_shape
+        # or _match_shape
+        if shape == '?':
+            return True
+        elif isinstance(shape, dict) and isinstance(value, dict):
+            return dict((k, self._project_to_shape(value[k], v, missing) if k in value else missing)
+                        for k, v in shape.items())
+        elif isinstance(shape, list) and isinstance(value, list):
+            return [self._project_to_shape(element, shape[0], missing) for element in value]
+        return value
+
+    def _fingerprint(self, value, shape, missing=_MISSING, key=None):
+        # hashable form of value projected on shape, equal for values the
+        # comparison of that shape takes as equal
+        return self._freeze(self._project_to_shape(value, shape, missing), key)
+
+    def _diff_streams(self, current_objects, update_objects):
+        # merge-joins two iterables of objects sorted by identifier into
+        # (operation, current object, update object) tuples, operation being
+        # one of create, update, delete or unchanged. Only one object of each
+        # side is held at a time, so either side can be a generator.
+        current_objects = iter(current_objects)
+        update_objects = iter(update_objects)
+        current_object = self._next_sorted_object(current_objects)
+        update_object = self._next_sorted_object(update_objects)
+        while current_object is not None or update_object is not None:
+            if update_object is None or (current_object is not None and
+                                         current_object[self._object_identifier] < update_object[self._object_identifier]):
+                yield 'delete', current_object, None
+                current_object = self._next_sorted_object(current_objects, current_object)
+            elif current_object is None or update_object[self._object_identifier] < current_object[self._object_identifier]:
+                yield 'create', None, update_object
+                update_object = self._next_sorted_object(update_objects, update_object)
+            else:
+                current_object = self._expand_defaults(current_object)
+                yield 'unchanged' if self._objects_match(current_object, update_object) else 'update', \
+                    current_object, update_object
+                current_object = self._next_sorted_object(current_objects, current_object)
+                update_object = self._next_sorted_object(update_objects, update_object)
+
+    def _next_sorted_object(self, forti_objects, previous_object=None):
+        forti_object = next(forti_objects, None)
+        if forti_object is not None and previous_object is not None and \
+                forti_object[self._object_identifier] < previous_object[self._object_identifier]:
+            self.fail("Objects at %s are not sorted by %s" % (self._endpoint, self._object_identifier))
+        return forti_object
 
     def _diff_dicts(self, current, update):
         diff = {}
@@ -1001,7 +1878,7 @@ class API(object):
                     current_val = current[key]
                 except KeyError:
                     self.fail('Could not find key %s' % str(key))
-                sub_val = self._diff_unknown(current_val, update_val)
+                sub_val = self._diff_unknown(current_val, update_val, key)
                 if sub_val is not False:
                     diff[key] = sub_val
             elif key not in self._match_ignore_params:
@@ -1010,7 +1887,7 @@ class API(object):
             return None
         return diff
 
-    def _diff_lists(self, current, update):
+    def _diff_lists(self, current, update, key=None):
         if current is None or len(current) != len(update):
             return update
 
@@ -1019,11 +1896,11 @@ class API(object):
             current_val = current[i]
             diff.append(self._diff_unknown(current_val, update_val))
 
-        if not any(diff):
+        if not any(diff) or self._lists_match(current, update, key):
             diff = None
         return diff
 
-    def _diff_unknown(self, current, update):
+    def _diff_unknown(self, current, update, key=None):
 
         if isinstance(update, dict):
             diff = self._diff_dicts(current, update)
@@ -1035,7 +1912,7 @@ class API(object):
                 return None
 
         elif isinstance(update, list):
-            diff = self._diff_lists(current, update)
+            diff = self._diff_lists(current, update, key)
             if diff and any(diff):
                 return diff
             elif diff is []:
@@ -0,0 +1,261 @@
+# This code is part of Ansible, but is an independent component.
+# This particular file snippet, and this file snippet only, is BSD licensed.
+# Modules you write using this snippet, which is embedded dynamically by Ansible
+# still belong to the author of the module, and may assign their own license
+# to the complete work.
+#
+# Copyright (c) API class, Will Wagner <willwagner602@gmail.com> and Eugene Opredelennov <eoprede@gmail.com>, 2017
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# asyncio variant of the API class. It needs Python 3 and is kept apart from
+# fortios_api.py so that file can still be imported by Python 2 modules.
+import asyncio
+from collections import OrderedDict
+
+from ansible.module_utils.fortios_api import API, HAS_IJSON
+
+try:
+    import aiohttp
+
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+if HAS_IJSON:
+    import ijson
+
+
+class AsyncAPI(API):
+    # Login, argument spec and default object retrieval are done by the API
+    # class at init time. Fetch, delete, update, create and verify phases run
+    # as coroutines, with up to max_concurrency requests in flight.
+
+    def __init__(self, api_info):
+        super(AsyncAPI, self).__init__(api_info)
+        if not HAS_AIOHTTP:
+            self.fail(
+                'Could not import the python library aiohttp required by AsyncAPI.')
+        self._client = None
+
+    def apply_configuration_to_endpoint(self):
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(self.reconcile())
+        finally:
+            loop.close()
+        self._module.exit_json(**result)
+
+    async def reconcile(self):
+        async with self._open_client():
+            await self._execute_config_changes_async()
+            if not self._check_mode:
+                message, changed, failed = await self._process_response_async()
+            else:
+                message = "Check Mode"
+                changed = bool(self._change_plan)
+                failed = False
+
+        return dict(msg=message, changed=changed, failed=failed, plan=self._change_plan.to_dict(),
+                    existing=self._fortigate_original_config,
+                    proposed=self._update_config, end_state=self._fortigate_current_config)
+
+    def _open_client(self):
+        headers = dict(self._session.headers)
+        if self.header:
+            headers.update(self.header)
+        cookies = dict((c.name, c.value) for c in self.cookies) if self.cookies else None
+        connector = aiohttp.TCPConnector(limit=self._max_concurrency, ssl=None if self._verify else False)
+        self._client = aiohttp.ClientSession(headers=headers, cookies=cookies, connector=connector)
+        return self._client
+
+    async def _execute_config_changes_async(self):
+        self._touched_object_ids = OrderedDict()
+        await self._get_current_configuration_async()
+        if isinstance(self._fortigate_current_config, list):
+            cleared = await self._clear_endpoint_async()
+            self._plan_changes()
+            self._change_plan.cleared = cleared
+            await self._delete_unused_objects_async()
+            await self._update_objects_async()
+            await self._create_new_objects_async()
+        else:
+            self._select_single_object_update()
+            self._plan_changes()
+            await self._update_single_object_endpoint_async()
+
+    async def _get_current_configuration_async(self):
+        self._set_current_configuration(self._merge_fetch_responses(await self._gather(
+            self._show_endpoint_async, self._build_fetch_params())))
+
+    async def _clear_endpoint_async(self):
+        if not self._delete_all_objects():
+            return False
+        self._touched_object_ids = None
+        await self._remove_async(self._endpoint)
+        await self._get_current_configuration_async()
+        return True
+
+    async def _delete_unused_objects_async(self):
+        unused_objects = self._change_plan.deletes
+        if self._check_mode:
+            self._remove_objects_from_current_config(unused_objects)
+            return
+
+        self._process_delete_responses(unused_objects, await self._gather(self._remove_object_async, unused_objects))
+
+    async def _update_objects_async(self):
+        failures = {}
+        if not self._check_mode:
+            update_objects = self._get_objects_to_update()
+            self._collect_failures(update_objects, await self._gather(
+                self._edit_object_async, update_objects), failures)
+            reset_objects = self._get_objects_to_reset()
+            self._collect_failures(reset_objects, await self._gather(
+                self._edit_object_async, reset_objects), failures)
+        self._check_update_failures(failures)
+
+    async def _create_new_objects_async(self):
+        if not self._update_config:
+            return
+        new_objects = self._get_new_objects()
+        failures = {}
+        if not self._check_mode:
+            self._collect_failures(new_objects, await self._gather(
+                self._create_object_async, new_objects), failures)
+        self._check_create_failures(failures)
+
+    async def _update_single_object_endpoint_async(self):
+        if not self._check_mode and self._change_plan.updates:
+            await self._edit_async(self._endpoint, data=self._update_config)
+
+    async def _process_response_async(self):
+        verification_params = self._build_verification_params()
+        if verification_params is None:
+            await self._get_current_configuration_async()
+        else:
+            self._set_verified_configuration(await self._gather(self._show_endpoint_async, verification_params))
+        result = self._evaluate_applied_configuration()
+        if result is None:
+            await self._rollback_config_async()
+            self._report_rollback()
+        return result
+
+    async def _rollback_config_async(self):
+        temp = self._update_config
+        self._update_config = self._fortigate_original_config
+        await self._execute_config_changes_async()
+        self._update_config = temp
+        await self._get_current_configuration_async()
+
+    async def _gather(self, func, items):
+        # asyncio.gather keeps results in the order of items
+        return await asyncio.gather(*[func(item) for item in items])
+
+    async def _show_endpoint_async(self, params):
+        cached_response = self._get_cached_response(self._endpoint, params)
+        if cached_response is not None:
+            return cached_response
+        return self._cache_response(self._endpoint, params, await self._fetch_endpoint_async(params))
+
+    async def _fetch_endpoint_async(self, params):
+        if not self._page_size and not self._stream_results:
+            return await self._show_async(self._endpoint, params=params)
+
+        objects = OrderedDict()
+        start = 0
+        while True:
+            page_params = self._build_page_params(params, start) if self._page_size else params
+            known = len(objects)
+            if self._stream_results:
+                merged, response = await self._stream_page_async(objects, page_params, start)
+            else:
+                response = await self._show_async(self._endpoint, params=page_params)
+                merged = self._merge_page(objects, response, start)
+            if merged is None:
+                return response
+            if not self._page_size or self._is_last_page(objects, known, merged):
+                return {'results': list(objects.values())}
+            start += self._page_size
+
+    async def _stream_page_async(self, objects, params, start):
+        # same as API._stream_page, the results array is decoded from the
+        # response stream one object at a time
+        stream = self._start_stream(start)
+        try:
+            async with self._client.get(self._ip + '/api/v2/' + self._endpoint, params=self._build_params(params),
+                                        proxy=self._get_proxy()) as response:
+                async for prefix, event, value in ijson.parse_async(response.content, use_float=True):
+                    self._handle_stream_event(stream, objects, prefix, event, value)
+        except ijson.JSONError:
+            self.fail("Empty response received from endpoint %s for AsyncAPI._stream_page_async" % self._endpoint)
+        except aiohttp.ClientError as e:
+            self.fail("Connection to API endpoint %s failed while streaming results: %s" % (self._endpoint, e))
+        return stream['merged'], stream['envelope']
+
+    async def _remove_object_async(self, object_identifier):
+        return await self._remove_async('/'.join([self._endpoint, str(object_identifier)]))
+
+    async def _edit_object_async(self, forti_object):
+        return await self._edit_async(self._endpoint + "/%s" % str(forti_object[self._object_identifier]),
+                                      data=forti_object)
+
+    async def _create_object_async(self, forti_object):
+        return await self._create_async(self._endpoint, data=forti_object)
+
+    async def _show_async(self, path, api='v2', params=None):
+        return await self._request_async('GET', path, api=api, params=params)
+
+    async def _edit_async(self, path, api='v2', params=None, data=None):
+        return await self._request_async('PUT', path, api=api, params=params, data=data)
+
+    async def _create_async(self, path, api='v2', params=None, data=None):
+        return await self._request_async('POST', path, api=api, params=params, data=data)
+
+    async def _remove_async(self, path, api='v2', params=None, data=None):
+        return await self._request_async('DELETE', path, api=api, params=params, data=data)
+
+    async def _request_async(self, method, path, api='v2', params=None, data=None):
+        if isinstance(path, list):
+            path = '/'.join(path) + '/'
+        kwargs = dict(params=self._build_params(params), proxy=self._get_proxy())
+        if method != 'GET':
+            self._invalidate_cached_responses(path)
+            kwargs['json'] = {'json': data}
+        try:
+            async with self._client.request(method, self._ip + '/api/' + api + '/' + path, **kwargs) as response:
+                try:
+                    return await response.json(content_type=None)
+                except (ValueError, TypeError):
+                    self.fail("Empty response received from endpoint %s for AsyncAPI.%s" % (path, method))
+        except aiohttp.ClientError as e:
+            self.fail("Connection to API endpoint %s failed: %s" % (self._endpoint, e))
+
+    def _get_proxy(self):
+        if self.proxies:
+            return self.proxies.get(self._ip.split(':')[0])
+        return None
+
+
+async def reconcile_endpoints(apis):
+    # drives several endpoints (or the same endpoint in several vdoms) from a
+    # single event loop and returns their results in the order given
+    return await asyncio.gather(*[api.reconcile() for api in apis])